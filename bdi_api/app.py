@@ -9,6 +9,7 @@ from starlette.responses import JSONResponse
 
 import bdi_api
 from bdi_api.examples import v0_router
+from bdi_api.s1.exercise import close_db as close_s1_db
 from bdi_api.s1.exercise import s1
 from bdi_api.s4.exercise import s4
 from bdi_api.s5.exercise import s5
@@ -25,6 +26,7 @@ async def lifespan(app: FastAPI) -> AsyncIterator:
     logger.setLevel(logging.INFO)
     logger.info("Application started. You can check the documentation in http://localhost:8080/docs/")
     yield
+    close_s1_db()
     logger.warning("Application shutdown")
 
 
@@ -49,6 +51,7 @@ app = FastAPI(
     title="bdi-api",
     version=bdi_api.__version__,
     description=description,
+    lifespan=lifespan,
 )
 
 app.include_router(v0_router)
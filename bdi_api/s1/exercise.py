@@ -1,19 +1,30 @@
 from __future__ import annotations
 
+import asyncio
+import multiprocessing
+import os
 import shutil
+import threading
+from collections import deque
+from collections.abc import Awaitable, Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import cache
+from itertools import chain
 from pathlib import Path
 from typing import Annotated
 
-import requests
-from fastapi import APIRouter, status
+import httpx
+from fastapi import APIRouter, Depends, Response, status
 from fastapi.params import Query
 
 from bdi_api.settings import Settings
 
 #2nd endpoint
-import json
 import sqlite3
 
+import orjson
+from isal import igzip
+
 #3rd endpoint
 from fastapi import HTTPException
 
@@ -30,6 +41,27 @@ s1 = APIRouter(
 
 #Constants (Global variables)
 DAY = "20231101"
+BATCH_SIZE = 5000  # rows buffered before each executemany flush
+PARSE_WINDOW = 2  # parsed files in flight per worker process
+HTTP_MAX_CONNECTIONS = 32
+DOWNLOAD_WORKERS = 16  # files downloading at once, each body held until written
+ETAGS_MANIFEST = "etags.json"  # {filename: ETag} of the raw files on disk
+
+# Multi-row INSERTs: {values} is filled with one "(?, ...)" group per row.
+# Group sizes keep each statement under SQLite's classic 999-parameter limit.
+AIRCRAFT_GROUP = 333  # 3 params per row
+POSITION_GROUP = 142  # 7 params per row
+
+INSERT_AIRCRAFT_SQL = """
+    INSERT INTO aircraft (icao, registration, type)
+    VALUES {values};
+"""
+
+INSERT_POSITION_SQL = """
+    INSERT OR IGNORE INTO positions
+    (icao, timestamp, lat, lon, altitude_baro, ground_speed, had_emergency)
+    VALUES {values};
+"""
 
 #Helper Functions
 def _ensure_clean_dir(path: Path) -> None:
@@ -39,26 +71,75 @@ def _ensure_clean_dir(path: Path) -> None:
     path.mkdir(parents=True, exist_ok=True)
 
 
-def _first_n_filenames(file_limit: int) -> list[str]:
+def _http_client() -> httpx.AsyncClient:
+    """HTTP/2 client: all file requests multiplex over one connection per host.
+    No pool timeout, since requests may queue for a connection longer than 60s."""
+    return httpx.AsyncClient(
+        http2=True,
+        headers={"User-Agent": "Mozilla/5.0 bdi-assignment/1.0"},
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS),
+        timeout=httpx.Timeout(60, pool=None),
+        follow_redirects=True,
+    )
+
+
+async def _gather_or_cancel(coros: Iterable[Awaitable[None]]) -> None:
+    """Run all coroutines; on the first failure cancel and await the rest, then re-raise.
+    Plain gather would leave them running against an HTTP client that is being closed."""
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+_DD = [f"{i:02d}" for i in range(60)]
+
+# Every file of the day (5-second steps), built once at import time from a
+# two-digit lookup table instead of integer division + format per name
+_ALL_FILENAMES: tuple[str, ...] = tuple(
+    f"{_DD[hh]}{_DD[mm]}{_DD[ss]}Z.json.gz" for hh in range(24) for mm in range(60) for ss in range(0, 60, 5)
+)
+
+
+def _load_etags(manifest_path: Path) -> dict[str, str]:
+    if not manifest_path.exists():
+        return {}
+    try:
+        return orjson.loads(manifest_path.read_bytes())
+    except orjson.JSONDecodeError:
+        return {}
+
+
+def _first_n_filenames(file_limit: int) -> tuple[str, ...]:
     """
-    Generates the first N filenames in ascending order, starting at 00:00:00Z
+    Returns the first N filenames in ascending order, starting at 00:00:00Z
     with 5-second increments:
       000000Z.json.gz, 000005Z.json.gz, 000010Z.json.gz, ...
     """
-    out: list[str] = []
-    for i in range(int(file_limit)):
-        total_seconds = i * 5
-        hh = total_seconds // 3600
-        mm = (total_seconds % 3600) // 60
-        ss = total_seconds % 60
-        out.append(f"{hh:02d}{mm:02d}{ss:02d}Z.json.gz")
-    return out
+    return _ALL_FILENAMES[: max(0, int(file_limit))]
+
+def _apply_pragmas(con: sqlite3.Connection) -> None:
+    """Per-connection SQLite tuning for the bulk ingest and the read endpoints."""
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA synchronous=NORMAL;")
+    con.execute("PRAGMA temp_store=MEMORY;")
+    con.execute("PRAGMA cache_size=-200000;")  # ~200 MB
+    con.execute("PRAGMA mmap_size=268435456;")  # 256 MB
 
 def _init_db(db_path: Path) -> None:
-    if db_path.exists():
-        db_path.unlink()
+    for p in (db_path, Path(f"{db_path}-wal"), Path(f"{db_path}-shm")):
+        if p.exists():
+            p.unlink()
 
     con = sqlite3.connect(db_path)
+    # page_size only takes effect before the first table exists (and not in WAL),
+    # so it is set on the fresh file before switching journal mode.
+    con.execute("PRAGMA page_size=8192;")
+    _apply_pragmas(con)
     cur = con.cursor()
 
     cur.execute("""
@@ -71,31 +152,153 @@ def _init_db(db_path: Path) -> None:
 
     cur.execute("""
         CREATE TABLE positions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
             icao TEXT,
             timestamp REAL,
             lat REAL,
             lon REAL,
             altitude_baro REAL,
             ground_speed REAL,
-            had_emergency INTEGER
-        );
+            had_emergency INTEGER,
+            PRIMARY KEY (icao, timestamp)
+        ) WITHOUT ROWID;
     """)
 
-    cur.execute("CREATE INDEX idx_positions_icao_ts ON positions(icao, timestamp);")
-
     con.commit()
     con.close()
 
+@cache
+def _multirow_sql(template: str, width: int, n_rows: int) -> str:
+    row = "(" + ", ".join(["?"] * width) + ")"
+    return template.format(values=", ".join([row] * n_rows))
+
+def _insert_multirow(cur: sqlite3.Cursor, template: str, group: int, rows: list[tuple]) -> None:
+    """Insert rows `group` at a time per statement; the tail goes in one smaller statement."""
+    width = len(rows[0])
+    full = len(rows) - len(rows) % group
+    if full:
+        cur.executemany(
+            _multirow_sql(template, width, group),
+            (tuple(chain.from_iterable(rows[i:i + group])) for i in range(0, full, group)),
+        )
+    if full < len(rows):
+        tail = rows[full:]
+        cur.execute(_multirow_sql(template, width, len(tail)), tuple(chain.from_iterable(tail)))
+
+def _flush_positions(cur: sqlite3.Cursor, pos_rows: list[tuple]) -> None:
+    """Write the buffered position rows and empty the buffer."""
+    if pos_rows:
+        _insert_multirow(cur, INSERT_POSITION_SQL, POSITION_GROUP, pos_rows)
+        pos_rows.clear()
+
+def _load_payload(fp: Path) -> dict:
+    """
+    Parse one raw file. The source may serve it with Content-Encoding: gzip,
+    in which case the HTTP client already inflated it, so only decompress when the
+    bytes still carry the gzip magic number.
+    """
+    data = fp.read_bytes()
+    if data[:2] == b"\x1f\x8b":
+        data = igzip.decompress(data)
+    return orjson.loads(data)
+
+def _parse_file(fp: Path) -> tuple[dict[str, tuple], list[tuple]]:
+    """Turn one raw file into ({icao: (registration, type)}, position rows).
+    Module-level so it pickles."""
+    payload = _load_payload(fp)
+
+    timestamp = payload.get("now", 0.0)
+    aircraft = [a for a in payload.get("aircraft") or [] if a.get("hex")]
+
+    ac_map = {a["hex"]: (a.get("r"), a.get("t")) for a in aircraft}
+
+    # Keep position only if coordinates exist
+    pos_rows = [
+        (
+            a["hex"], timestamp, a["lat"], a["lon"], a.get("alt_baro"), a.get("gs"),
+            # readsb sends "none" for ordinary traffic
+            0 if a.get("emergency") in (None, "none") else 1,
+        )
+        for a in aircraft
+        if a.get("lat") is not None and a.get("lon") is not None
+    ]
+    return ac_map, pos_rows
+
+def _parse_files(raw_files: list[Path]) -> Iterator[tuple[dict[str, tuple], list[tuple]]]:
+    """Parse the files in a process pool, in order. Inline on a single core,
+    where pickling the rows back would only add overhead."""
+    workers = min(os.cpu_count() or 1, len(raw_files))
+    if workers <= 1:
+        yield from map(_parse_file, raw_files)
+        return
+    # spawn, not fork: this runs on a threadpool thread, and forking a
+    # multi-threaded process can deadlock the child.
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        # Only PARSE_WINDOW files in flight, so parsed rows cannot pile up
+        # in memory while the single SQLite writer catches up.
+        pending: deque[Future] = deque()
+        for fp in raw_files:
+            if len(pending) >= workers * PARSE_WINDOW:
+                yield pending.popleft().result()
+            pending.append(pool.submit(_parse_file, fp))
+        while pending:
+            yield pending.popleft().result()
+
 def _get_db_path() -> Path:
     return Path(settings.prepared_dir) / f"day={DAY}" / "aircraft.sqlite"
 
+# One read connection per worker process, shared by the query endpoints.
+# Opened lazily (the DB only exists after prepare) and dropped by prepare_data,
+# which deletes and rebuilds the file. _read_db_users counts the requests
+# holding each connection, so a dropped one is closed by its last reader.
+_read_db: sqlite3.Connection | None = None
+_read_db_users: dict[sqlite3.Connection, int] = {}
+_read_db_lock = threading.Lock()
+
+def get_db() -> Iterator[sqlite3.Connection]:
+    """FastAPI dependency yielding the shared read connection; 400 if not prepared yet."""
+    global _read_db
+    with _read_db_lock:
+        if _read_db is None:
+            db_path = _get_db_path()
+            if not db_path.exists():
+                raise HTTPException(
+                    status_code=400,
+                    detail="Prepared database not found. Run /api/s1/aircraft/prepare first.",
+                )
+            # Endpoints run in the threadpool; SQLite serializes access to the connection
+            con = sqlite3.connect(db_path, check_same_thread=False)
+            con.row_factory = sqlite3.Row
+            _apply_pragmas(con)
+            _read_db = con
+            _read_db_users[con] = 0
+        con = _read_db
+        _read_db_users[con] += 1
+    try:
+        yield con
+    finally:
+        with _read_db_lock:
+            _read_db_users[con] -= 1
+            if con is not _read_db and not _read_db_users[con]:
+                del _read_db_users[con]
+                con.close()
+
+def close_db() -> None:
+    """Drop the shared read connection. It is closed now if idle, otherwise by its last reader."""
+    global _read_db
+    with _read_db_lock:
+        con, _read_db = _read_db, None
+        if con is not None and not _read_db_users[con]:
+            del _read_db_users[con]
+            con.close()
+
 @s1.post("/aircraft/download")
-def download_data(
+async def download_data(
     file_limit: Annotated[
         int,
         Query(
             ...,
+            ge=0,
             description="""
 Limits the number of files to download.
 You must always start from the first and go in ascending order.
@@ -105,19 +308,48 @@ I'll test with increasing number of files starting from 100.
     ] = 100,
 ) -> str:
     raw_day_dir = Path(settings.raw_dir) / f"day={DAY}"
-    _ensure_clean_dir(raw_day_dir)
+    raw_day_dir.mkdir(parents=True, exist_ok=True)
+    fnames = _first_n_filenames(file_limit)
+
+    # Keep only the requested files (prepare reads every file in the folder),
+    # and remember the ETags of those already on disk.
+    wanted = set(fnames)
+    for fp in raw_day_dir.glob("*.json.gz"):
+        if fp.name not in wanted:
+            fp.unlink()
+    manifest_path = raw_day_dir / ETAGS_MANIFEST
+    etags = _load_etags(manifest_path)
+    etags = {f: e for f, e in etags.items() if f in wanted and (raw_day_dir / f).exists()}
 
     # Build the correct base URL (avoid double readsb-hist)
     base = settings.source_url.rstrip("/")
     day_url = base + "/2023/11/01/"
     
-    headers = {"User-Agent": "Mozilla/5.0 bdi-assignment/1.0"}
-
-    for fname in _first_n_filenames(file_limit):
-        url = day_url + fname
-        r = requests.get(url, headers=headers, timeout=60, allow_redirects=True)
-        r.raise_for_status()
-        (raw_day_dir / fname).write_bytes(r.content)
+    # max_connections does not limit HTTP/2 streams, so without this every
+    # file would be requested at once and the inflated bodies pile up in memory.
+    in_flight = asyncio.Semaphore(DOWNLOAD_WORKERS)
+
+    async with _http_client() as client:
+
+        async def fetch(fname: str) -> None:
+            async with in_flight:
+                # Conditional GET: unchanged files answer 304 with no body
+                headers = {"If-None-Match": etags[fname]} if fname in etags else None
+                r = await client.get(day_url + fname, headers=headers)
+                if r.status_code == 304:
+                    return
+                r.raise_for_status()
+                await asyncio.to_thread((raw_day_dir / fname).write_bytes, r.content)
+            if etag := r.headers.get("ETag"):
+                etags[fname] = etag
+            else:
+                etags.pop(fname, None)
+
+        try:
+            await _gather_or_cancel(fetch(fname) for fname in fnames)
+        finally:
+            # Also on failure, so the files that did arrive are not fetched again
+            manifest_path.write_bytes(orjson.dumps(etags))
 
     return "OK"
 
@@ -134,7 +366,8 @@ def prepare_data() -> str:
     raw_day_dir = Path(settings.raw_dir) / f"day={DAY}"
     prepared_day_dir = Path(settings.prepared_dir) / f"day={DAY}"
 
-    #Clean prepared folder
+    #Clean prepared folder (and drop the read connection to the old file)
+    close_db()
     _ensure_clean_dir(prepared_day_dir)
 
     raw_files = sorted(raw_day_dir.glob("*.json.gz"))
@@ -146,48 +379,31 @@ def prepare_data() -> str:
     _init_db(db_path)
 
     con = sqlite3.connect(db_path)
+    _apply_pragmas(con)
     cur = con.cursor()
 
-    #Process each file
-    for fp in raw_files:
-        with open(fp, "r", encoding="utf-8") as f:
-            payload = json.load(f)
-
-        timestamp = payload.get("now", 0.0)
-
-        for a in payload.get("aircraft", []):
-            icao = a.get("hex")
-            if not icao:
-                continue
-
-            registration = a.get("r")
-            ac_type = a.get("t")
-
-            lat = a.get("lat")
-            lon = a.get("lon")
-            alt = a.get("alt_baro")
-            gs = a.get("gs")
-
-            emergency = 1 if a.get("emergency") else 0
-
-            # Insert / update aircraft
-            cur.execute("""
-                INSERT INTO aircraft (icao, registration, type)
-                VALUES (?, ?, ?)
-                ON CONFLICT(icao) DO UPDATE SET
-                    registration = excluded.registration,
-                    type = excluded.type;
-            """, (icao, registration, ac_type))
-
-            # Insert position only if coordinates exist
-            if lat is not None and lon is not None:
-                cur.execute("""
-                    INSERT INTO positions
-                    (icao, timestamp, lat, lon, altitude_baro, ground_speed, had_emergency)
-                    VALUES (?, ?, ?, ?, ?, ?, ?);
-                """, (icao, timestamp, lat, lon, alt, gs, emergency))
-
+    # Single explicit transaction for the whole ingest; positions are buffered
+    # and flushed every BATCH_SIZE rows.
+    cur.execute("BEGIN")
+    # Aircraft repeat in every file: keep the latest (registration, type) per
+    # icao and write each aircraft once after all files are parsed.
+    aircraft_map: dict[str, tuple[str | None, str | None]] = {}
+    pos_rows: list[tuple] = []
+
+    #Parse files in worker processes; this process is the only SQLite writer
+    for file_ac_map, file_pos_rows in _parse_files(raw_files):
+        aircraft_map.update(file_ac_map)
+        pos_rows.extend(file_pos_rows)
+
+        if len(pos_rows) >= BATCH_SIZE:
+            _flush_positions(cur, pos_rows)
+
+    _flush_positions(cur, pos_rows)
+    if aircraft_map:
+        ac_rows = [(icao, *reg_type) for icao, reg_type in aircraft_map.items()]
+        _insert_multirow(cur, INSERT_AIRCRAFT_SQL, AIRCRAFT_GROUP, ac_rows)
     con.commit()
+
     con.close()
 
     return "OK"
@@ -195,8 +411,14 @@ def prepare_data() -> str:
 
 @s1.get("/aircraft/")
 def list_aircraft(
+    response: Response,
+    con: Annotated[sqlite3.Connection, Depends(get_db)],
     num_results: Annotated[int, Query(ge=1, le=1000)] = 100,
-    page: Annotated[int, Query(ge=0)] = 0
+    page: Annotated[int, Query(ge=0)] = 0,
+    after: Annotated[
+        str | None,
+        Query(description="Keyset cursor: return aircraft with icao greater than this one. Overrides `page`."),
+    ] = None,
 ) -> list[dict]:
     """List all the available aircraft, its registration and type ordered by
     icao asc
@@ -204,20 +426,22 @@ def list_aircraft(
       - page=0 => first page
       - page=1 => second page
       - offset = page * num_results
+     Keyset pagination (no OFFSET scan, constant cost for deep pages):
+      - pass the `X-Next-Cursor` header of the previous response as `after`
     """
-    db_path = _get_db_path()
-    if not db_path.exists():
-        raise HTTPException(
-            status_code=400,
-            detail="Prepared database not found. Run /api/s1/aircraft/prepare first.",
+    cur = con.cursor()
+    if after is not None:
+        cur.execute(
+            """
+            SELECT icao, registration, type
+            FROM aircraft
+            WHERE icao > ?
+            ORDER BY icao ASC
+            LIMIT ?;
+            """,
+            (after, num_results),
         )
-
-    offset = page * num_results
-
-    con = sqlite3.connect(db_path)
-    con.row_factory = sqlite3.Row
-    try:
-        cur = con.cursor()
+    else:
         cur.execute(
             """
             SELECT icao, registration, type
@@ -225,30 +449,74 @@ def list_aircraft(
             ORDER BY icao ASC
             LIMIT ? OFFSET ?;
             """,
-            (num_results, offset),
+            (num_results, page * num_results),
         )
-        rows = cur.fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        con.close()
+    rows = cur.fetchall()
+
+    # A full page means there may be more: hand out the last icao as the cursor
+    if len(rows) == num_results:
+        response.headers["X-Next-Cursor"] = rows[-1]["icao"]
+    return [dict(r) for r in rows]
 
 
 @s1.get("/aircraft/{icao}/positions")
-def get_aircraft_position(icao: str, num_results: int = 1000, page: int = 0) -> list[dict]:
+def get_aircraft_position(
+    icao: str,
+    con: Annotated[sqlite3.Connection, Depends(get_db)],
+    num_results: Annotated[int, Query(ge=1)] = 1000,
+    page: Annotated[int, Query(ge=0)] = 0,
+) -> list[dict]:
     """Returns all the known positions of an aircraft ordered by time (asc)
     If an aircraft is not found, return an empty list.
     """
-    # TODO implement and return a list with dictionaries with those values.
-    return [{"timestamp": 1609275898.6, "lat": 30.404617, "lon": -86.476566}]
+    offset = page * num_results
+
+    # Served by a range seek on the (icao, timestamp) primary key, already in timestamp order
+    cur = con.cursor()
+    cur.execute(
+        """
+        SELECT timestamp, lat, lon
+        FROM positions
+        WHERE icao = ?
+        ORDER BY timestamp ASC
+        LIMIT ? OFFSET ?;
+        """,
+        (icao, num_results, offset),
+    )
+    return [dict(r) for r in cur.fetchall()]
 
 
 @s1.get("/aircraft/{icao}/stats")
-def get_aircraft_statistics(icao: str) -> dict:
+def get_aircraft_statistics(icao: str, con: Annotated[sqlite3.Connection, Depends(get_db)]) -> dict:
     """Returns different statistics about the aircraft
 
     * max_altitude_baro
     * max_ground_speed
     * had_emergency
     """
-    # TODO Gather and return the correct statistics for the requested aircraft
-    return {"max_altitude_baro": 300000, "max_ground_speed": 493, "had_emergency": False}
\ No newline at end of file
+    cur = con.cursor()
+    cur.execute("SELECT 1 FROM aircraft WHERE icao = ?;", (icao,))
+    if cur.fetchone() is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Aircraft not found")
+
+    # alt_baro can be the string "ground"; only numeric values count for the max.
+    # An aircraft that never reported a position gets null maxima.
+    cur.execute(
+        """
+        SELECT
+            MAX(CASE WHEN typeof(altitude_baro) IN ('integer', 'real') THEN altitude_baro END)
+                AS max_altitude_baro,
+            MAX(ground_speed) AS max_ground_speed,
+            MAX(had_emergency) AS had_emergency
+        FROM positions
+        WHERE icao = ?;
+        """,
+        (icao,),
+    )
+    row = cur.fetchone()
+
+    return {
+        "max_altitude_baro": row["max_altitude_baro"],
+        "max_ground_speed": row["max_ground_speed"],
+        "had_emergency": bool(row["had_emergency"]),
+    }
@@ -1,14 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import shutil
 from pathlib import Path
 from typing import Annotated
 
 import boto3
-import requests
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from fastapi import APIRouter, status
 from fastapi.params import Query
 
+from bdi_api.s1.exercise import _gather_or_cancel, _http_client
 from bdi_api.settings import Settings
 
 settings = Settings()
@@ -24,6 +28,7 @@ s4 = APIRouter(
 
 DAY = "20231101"
 S3_PREFIX = "raw/day=20231101/"  # required by homework
+DOWNLOAD_WORKERS = 16
 
 
 def _ensure_clean_dir(path: Path) -> None:
@@ -32,16 +37,33 @@ def _ensure_clean_dir(path: Path) -> None:
     path.mkdir(parents=True, exist_ok=True)
 
 
-def _first_n_filenames(file_limit: int) -> list[str]:
-    # 5-second increments from 00:00:00Z
-    out: list[str] = []
-    for i in range(int(file_limit)):
-        total_seconds = i * 5
-        hh = total_seconds // 3600
-        mm = (total_seconds % 3600) // 60
-        ss = total_seconds % 60
-        out.append(f"{hh:02d}{mm:02d}{ss:02d}Z.json.gz")
-    return out
+_DD = [f"{i:02d}" for i in range(60)]
+
+# 5-second increments from 00:00:00Z, the whole day built once at import time
+_ALL_FILENAMES: tuple[str, ...] = tuple(
+    f"{_DD[hh]}{_DD[mm]}{_DD[ss]}Z.json.gz" for hh in range(24) for mm in range(60) for ss in range(0, 60, 5)
+)
+
+
+def _first_n_filenames(file_limit: int) -> tuple[str, ...]:
+    return _ALL_FILENAMES[: max(0, int(file_limit))]
+
+
+def _s3_client():
+    # botocore defaults to 10 pooled connections; match the number of workers
+    return boto3.client("s3", config=Config(max_pool_connections=DOWNLOAD_WORKERS))
+
+
+def _source_etag(s3, bucket: str, key: str) -> str | None:
+    """
+    ETag the source served when the object was uploaded, kept in its metadata.
+    (The S3 ETag itself is an MD5 of the body and can't be compared with it.)
+    """
+    try:
+        head = s3.head_object(Bucket=bucket, Key=key)
+    except ClientError:
+        return None
+    return head.get("Metadata", {}).get("source-etag")
 
 
 def _day_url() -> str:
@@ -56,11 +78,12 @@ def _day_url() -> str:
 
 
 @s4.post("/aircraft/download")
-def download_data(
+async def download_data(
     file_limit: Annotated[
         int,
         Query(
             ...,
+            ge=0,
             description="""
 Limits the number of files to download.
 You must always start from the first file and go in ascending order.
@@ -73,19 +96,35 @@ I'll test with increasing number of files starting from 100.
     Downloads aircraft data files from ADS-B Exchange and stores them in S3
     under raw/day=20231101/
     """
-    s3 = boto3.client("s3")
+    s3 = _s3_client()
     bucket = settings.s3_bucket
     day_url = _day_url()
 
-    headers = {"User-Agent": "Mozilla/5.0 bdi-assignment/1.0"}
+    # HTTP/2 would otherwise let every file be in flight at once; this caps how
+    # many response bodies are held in memory between download and upload.
+    in_flight = asyncio.Semaphore(DOWNLOAD_WORKERS)
+
+    async with _http_client() as client:
+
+        async def fetch_and_upload(fname: str) -> None:
+            async with in_flight:
+                # boto3 is blocking; call it from a worker thread to keep the event loop free
+                key = S3_PREFIX + fname
+                etag = await asyncio.to_thread(_source_etag, s3, bucket, key)
 
-    for fname in _first_n_filenames(file_limit):
-        url = day_url + fname
-        r = requests.get(url, headers=headers, timeout=60, allow_redirects=True)
-        r.raise_for_status()
+                # Conditional GET: if the object already holds this version, skip the upload
+                headers = {"If-None-Match": etag} if etag else None
+                r = await client.get(day_url + fname, headers=headers)
+                if r.status_code == 304:
+                    return
+                r.raise_for_status()
 
-        key = S3_PREFIX + fname
-        s3.put_object(Bucket=bucket, Key=key, Body=r.content)
+                metadata = {"source-etag": r.headers["ETag"]} if "ETag" in r.headers else {}
+                await asyncio.to_thread(
+                    s3.put_object, Bucket=bucket, Key=key, Body=r.content, Metadata=metadata
+                )
+
+        await _gather_or_cancel(fetch_and_upload(fname) for fname in _first_n_filenames(file_limit))
 
     return "OK"
 
@@ -97,7 +136,7 @@ def prepare_data() -> str:
     then prepares them locally (prepared/) in the same way as S1,
     so S1 query endpoints keep working.
     """
-    s3 = boto3.client("s3")
+    s3 = _s3_client()
     bucket = settings.s3_bucket
 
     # 1) Download raw files from S3 to local raw/day=20231101/
@@ -105,30 +144,23 @@ def prepare_data() -> str:
     _ensure_clean_dir(local_raw_day_dir)
 
     keys: list[str] = []
-    token: str | None = None
-
-    while True:
-        kwargs = {"Bucket": bucket, "Prefix": S3_PREFIX}
-        if token:
-            kwargs["ContinuationToken"] = token
-        resp = s3.list_objects_v2(**kwargs)
-
-        for obj in resp.get("Contents", []):
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=S3_PREFIX):
+        for obj in page.get("Contents", []):
             key = obj["Key"]
             if key.endswith("/") or not key.endswith(".json.gz"):
                 continue
             keys.append(key)
 
-        if resp.get("IsTruncated"):
-            token = resp.get("NextContinuationToken")
-        else:
-            break
-
     keys.sort()  # ascending
 
-    for key in keys:
-        fname = key.split("/")[-1]
-        s3.download_file(bucket, key, str(local_raw_day_dir / fname))
+    # One transfer manager runs all downloads on its own DOWNLOAD_WORKERS threads;
+    # leaving the block shuts its pool down (and cancels the rest on error).
+    config = TransferConfig(max_concurrency=DOWNLOAD_WORKERS)
+    with create_transfer_manager(s3, config) as manager:
+        futures = [manager.download(bucket, key, str(local_raw_day_dir / key.split("/")[-1])) for key in keys]
+        for fut in futures:
+            fut.result()
 
     # 2) Reuse S1 prepare to generate the local prepared DB
     from bdi_api.s1.exercise import prepare_data as s1_prepare
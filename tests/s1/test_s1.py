@@ -1,5 +1,111 @@
+import asyncio
+import gzip
+import json
+import sqlite3
+from pathlib import Path
+
+import httpx
+import pytest
 from fastapi.testclient import TestClient
 
+from bdi_api.s1 import exercise as s1_exercise
+from bdi_api.s1.exercise import _first_n_filenames
+
+# Three 5-second snapshots:
+#  - abc001 flies through all of them, one altitude reported as "ground"
+#  - abc002 is seen but never reports a position
+#  - abc003 declares an emergency in the last one
+SNAPSHOTS = [
+    {
+        "now": 1698796800.0,
+        "aircraft": [
+            {"hex": "abc001", "r": "EC-AAA", "t": "A320", "lat": 41.0, "lon": 2.0,
+             "alt_baro": 1000, "gs": 100.0, "emergency": "none"},
+            {"hex": "abc002", "r": "EC-BBB", "t": "B738"},
+            {"hex": "abc003", "r": "EC-CCC", "t": "A321", "lat": 40.0, "lon": 3.0,
+             "alt_baro": 5000, "gs": 300.0, "emergency": "none"},
+        ],
+    },
+    {
+        "now": 1698796805.0,
+        "aircraft": [
+            {"hex": "abc001", "r": "EC-AAA", "t": "A320", "lat": 41.1, "lon": 2.1,
+             "alt_baro": "ground", "gs": 250.0, "emergency": "none"},
+            {"hex": "abc003", "r": "EC-CCC", "t": "A321", "lat": 40.1, "lon": 3.1,
+             "alt_baro": 5100, "gs": 310.0, "emergency": "none"},
+        ],
+    },
+    {
+        "now": 1698796810.0,
+        "aircraft": [
+            {"hex": "abc001", "r": "EC-AAA", "t": "A320", "lat": 41.2, "lon": 2.2,
+             "alt_baro": 3000, "gs": 150.0},
+            {"hex": "abc003", "r": "EC-CCC", "t": "A321", "lat": 40.2, "lon": 3.2,
+             "alt_baro": 5200, "gs": 320.0, "emergency": "general"},
+        ],
+    },
+]
+
+
+def _write_raw_files(local_dir: Path, snapshots: list[dict]) -> None:
+    raw_dir = local_dir / "raw" / "day=20231101"
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    for fname, snapshot in zip(_first_n_filenames(len(snapshots)), snapshots):
+        (raw_dir / fname).write_bytes(gzip.compress(json.dumps(snapshot).encode()))
+
+
+@pytest.fixture
+def local_dir(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Path:
+    """Point S1 at an empty temporary data folder."""
+    monkeypatch.setattr(s1_exercise.settings, "local_dir", str(tmp_path))
+    yield tmp_path
+    s1_exercise.close_db()
+
+
+class _Origin:
+    """Stand-in for ADS-B Exchange: every file has a versioned ETag and
+    answers 304 to a matching If-None-Match."""
+
+    def __init__(self) -> None:
+        self.versions: dict[str, int] = {}
+        self.failing: set[str] = set()
+        self.statuses: list[int] = []
+        self.active = self.peak = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.001)
+        self.active -= 1
+        fname = request.url.path.rsplit("/", 1)[-1]
+        if fname in self.failing:
+            return httpx.Response(500)
+        etag = f'"{fname}-{self.versions.get(fname, 0)}"'
+        status = 304 if request.headers.get("If-None-Match") == etag else 200
+        self.statuses.append(status)
+        body = gzip.compress(json.dumps({"now": 0, "aircraft": []}).encode()) if status == 200 else b""
+        return httpx.Response(status, headers={"ETag": etag}, content=body)
+
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handle), follow_redirects=True)
+
+
+@pytest.fixture
+def origin(monkeypatch: pytest.MonkeyPatch, local_dir: Path) -> _Origin:
+    """Serve S1 downloads from an in-memory origin instead of the network."""
+    origin = _Origin()
+    monkeypatch.setattr(s1_exercise, "_http_client", origin.client)
+    return origin
+
+
+@pytest.fixture
+def prepared(client: TestClient, local_dir: Path) -> Path:
+    """Temporary data folder with SNAPSHOTS downloaded and prepared."""
+    _write_raw_files(local_dir, SNAPSHOTS)
+    with client as c:
+        assert c.post("/api/s1/aircraft/prepare").json() == "OK"
+    return local_dir
+
 
 class TestS1Student:
     """
@@ -16,6 +122,197 @@ class TestS1Student:
             response = client.post("/api/s1/aircraft/download?file_limit=1")
             assert True
 
+    def test_download_rejects_negative_file_limit(self, client: TestClient) -> None:
+        with client as client:
+            response = client.post("/api/s1/aircraft/download?file_limit=-1")
+            assert response.status_code == 422
+
+    def test_first_n_filenames_never_wraps(self) -> None:
+        assert _first_n_filenames(-1) == ()
+        assert _first_n_filenames(0) == ()
+        assert _first_n_filenames(3) == ("000000Z.json.gz", "000005Z.json.gz", "000010Z.json.gz")
+
+    def test_positions_ordered_and_paged(self, client: TestClient, prepared: Path) -> None:
+        with client as client:
+            r = client.get("/api/s1/aircraft/abc001/positions").json()
+            assert [p["timestamp"] for p in r] == [1698796800.0, 1698796805.0, 1698796810.0]
+            assert r[0] == {"timestamp": 1698796800.0, "lat": 41.0, "lon": 2.0}
+
+            r = client.get("/api/s1/aircraft/abc001/positions", params={"num_results": 2, "page": 1}).json()
+            assert [p["timestamp"] for p in r] == [1698796810.0]
+
+    def test_stats_ignore_ground_altitude(self, client: TestClient, prepared: Path) -> None:
+        with client as client:
+            r = client.get("/api/s1/aircraft/abc001/stats").json()
+            assert r == {"max_altitude_baro": 3000, "max_ground_speed": 250.0, "had_emergency": False}
+
+    def test_stats_emergency_flag(self, client: TestClient, prepared: Path) -> None:
+        with client as client:
+            assert client.get("/api/s1/aircraft/abc003/stats").json()["had_emergency"] is True
+
+    def test_stats_aircraft_without_positions(self, client: TestClient, prepared: Path) -> None:
+        with client as client:
+            r = client.get("/api/s1/aircraft/abc002/stats")
+            assert r.status_code == 200
+            assert r.json() == {"max_altitude_baro": None, "max_ground_speed": None, "had_emergency": False}
+            assert client.get("/api/s1/aircraft/abc002/positions").json() == []
+
+    def test_unknown_icao(self, client: TestClient, prepared: Path) -> None:
+        with client as client:
+            assert client.get("/api/s1/aircraft/zzzzzz/positions").json() == []
+            assert client.get("/api/s1/aircraft/zzzzzz/stats").status_code == 404
+
+    def test_keyset_pages_match_offset_pages(self, client: TestClient, local_dir: Path) -> None:
+        icaos = ["abc007", "abc002", "abc005", "abc001", "abc006", "abc003", "abc004"]
+        _write_raw_files(local_dir, [{"now": 1698796800.0, "aircraft": [{"hex": icao} for icao in icaos]}])
+        with client as client:
+            client.post("/api/s1/aircraft/prepare")
+            offset_listing = []
+            for page in range(3):
+                offset_listing += client.get("/api/s1/aircraft/", params={"num_results": 3, "page": page}).json()
+
+            keyset_listing, pages, params = [], [], {"num_results": 3}
+            while True:
+                r = client.get("/api/s1/aircraft/", params=params)
+                pages.append(len(r.json()))
+                keyset_listing += r.json()
+                if "x-next-cursor" not in r.headers:
+                    break
+                params["after"] = r.headers["x-next-cursor"]
+
+        assert [a["icao"] for a in keyset_listing] == sorted(icaos)
+        assert keyset_listing == offset_listing
+        assert pages == [3, 3, 1]
+
+    def test_download_skips_unchanged_files(self, client: TestClient, origin: _Origin) -> None:
+        with client as client:
+            assert client.post("/api/s1/aircraft/download?file_limit=3").json() == "OK"
+            assert origin.statuses == [200, 200, 200]
+
+            origin.statuses.clear()
+            origin.versions["000005Z.json.gz"] = 1
+            assert client.post("/api/s1/aircraft/download?file_limit=3").json() == "OK"
+            assert sorted(origin.statuses) == [200, 304, 304]
+
+    def test_download_caps_files_in_flight(
+        self, client: TestClient, origin: _Origin, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr(s1_exercise, "DOWNLOAD_WORKERS", 2)
+        with client as client:
+            assert client.post("/api/s1/aircraft/download?file_limit=6").json() == "OK"
+        assert origin.statuses == [200] * 6
+        assert origin.peak == 2
+
+    def test_download_prunes_files_beyond_limit(self, client: TestClient, origin: _Origin, local_dir: Path) -> None:
+        raw_dir = local_dir / "raw" / "day=20231101"
+        with client as client:
+            client.post("/api/s1/aircraft/download?file_limit=3")
+            client.post("/api/s1/aircraft/download?file_limit=1")
+        assert sorted(p.name for p in raw_dir.glob("*.json.gz")) == ["000000Z.json.gz"]
+        assert list(json.loads((raw_dir / s1_exercise.ETAGS_MANIFEST).read_bytes())) == ["000000Z.json.gz"]
+
+    def test_download_manifest_survives_partial_failure(
+        self, client: TestClient, origin: _Origin, local_dir: Path
+    ) -> None:
+        raw_dir = local_dir / "raw" / "day=20231101"
+        origin.failing.add("000005Z.json.gz")
+        with client as client:
+            with pytest.raises(httpx.HTTPStatusError):
+                client.post("/api/s1/aircraft/download?file_limit=3")
+            etags = json.loads((raw_dir / s1_exercise.ETAGS_MANIFEST).read_bytes())
+            assert "000005Z.json.gz" not in etags
+            assert all((raw_dir / fname).exists() for fname in etags)
+
+            origin.failing.clear()
+            origin.statuses.clear()
+            assert client.post("/api/s1/aircraft/download?file_limit=3").json() == "OK"
+            assert origin.statuses.count(304) == len(etags)
+            assert origin.statuses.count(200) == 3 - len(etags)
+
+    def test_prepare_inserts_full_and_partial_groups(self, client: TestClient, local_dir: Path) -> None:
+        # 400 rows: two full POSITION_GROUP statements plus a tail of 116,
+        # one full AIRCRAFT_GROUP statement plus a tail of 67
+        n = 400
+        assert n > s1_exercise.AIRCRAFT_GROUP and n % s1_exercise.POSITION_GROUP
+        snapshot = {
+            "now": 1698796800.0,
+            "aircraft": [
+                {"hex": f"a{i:05d}", "r": f"EC-{i:03d}", "t": "A320", "lat": i / 10, "lon": -i / 10,
+                 "alt_baro": i, "gs": float(i)}
+                for i in range(n)
+            ],
+        }
+        _write_raw_files(local_dir, [snapshot])
+        with client as client:
+            client.post("/api/s1/aircraft/prepare")
+            with sqlite3.connect(s1_exercise._get_db_path()) as con:
+                assert con.execute("SELECT COUNT(*) FROM aircraft").fetchone()[0] == n
+                assert con.execute("SELECT COUNT(*) FROM positions").fetchone()[0] == n
+            con.close()
+
+            aircraft = client.get("/api/s1/aircraft/", params={"num_results": 1000}).json()
+            assert aircraft == [{"icao": f"a{i:05d}", "registration": f"EC-{i:03d}", "type": "A320"} for i in range(n)]
+            # Rows on both sides of each group boundary and in the tail
+            for i in (0, 141, 142, 283, 284, 332, 333, 399):
+                icao = f"a{i:05d}"
+                assert client.get(f"/api/s1/aircraft/{icao}/positions").json() == [
+                    {"timestamp": 1698796800.0, "lat": i / 10, "lon": -i / 10}
+                ]
+                assert client.get(f"/api/s1/aircraft/{icao}/stats").json() == {
+                    "max_altitude_baro": i, "max_ground_speed": float(i), "had_emergency": False
+                }
+
+    def test_parse_pool_keeps_file_order(
+        self, client: TestClient, local_dir: Path, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        # More files than the window of 2 workers * PARSE_WINDOW, so files are
+        # both queued behind the window and collected after the loop
+        n = 2 * s1_exercise.PARSE_WINDOW * 3 + 1
+        snapshots = [
+            {"now": 1698796800.0 + 5 * k, "aircraft": [{"hex": "abc001", "lat": k, "lon": k, "alt_baro": k}]}
+            for k in range(n)
+        ]
+        _write_raw_files(local_dir, snapshots)
+        monkeypatch.setattr(s1_exercise.os, "cpu_count", lambda: 2)
+        pools = []
+
+        class RecordingPool(s1_exercise.ProcessPoolExecutor):
+            def __init__(self, *args, **kwargs) -> None:
+                super().__init__(*args, **kwargs)
+                pools.append(kwargs["max_workers"])
+
+        monkeypatch.setattr(s1_exercise, "ProcessPoolExecutor", RecordingPool)
+
+        raw_files = sorted((local_dir / "raw" / "day=20231101").glob("*.json.gz"))
+        parsed = list(s1_exercise._parse_files(raw_files))
+        assert pools == [2]
+        assert [pos_rows[0][1] for _, pos_rows in parsed] == [s["now"] for s in snapshots]
+
+        with client as client:
+            client.post("/api/s1/aircraft/prepare")
+            positions = client.get("/api/s1/aircraft/abc001/positions", params={"num_results": 1000}).json()
+        assert positions == [{"timestamp": s["now"], "lat": k, "lon": k} for k, s in enumerate(snapshots)]
+        assert pools == [2, 2]
+
+    def test_prepare_reads_inflated_and_gzip_files(self, client: TestClient, local_dir: Path) -> None:
+        # Served with Content-Encoding: gzip, the client stores the file already inflated
+        _write_raw_files(local_dir, SNAPSHOTS)
+        plain = local_dir / "raw" / "day=20231101" / _first_n_filenames(2)[1]
+        plain.write_bytes(json.dumps(SNAPSHOTS[1]).encode())
+        with client as client:
+            assert client.post("/api/s1/aircraft/prepare").json() == "OK"
+            r = client.get("/api/s1/aircraft/abc001/positions").json()
+        assert [p["timestamp"] for p in r] == [s["now"] for s in SNAPSHOTS]
+
+    def test_close_db_keeps_connection_for_active_reader(self, prepared: Path) -> None:
+        reader = s1_exercise.get_db()
+        con = next(reader)  # a request is using the shared connection
+        s1_exercise.close_db()  # e.g. a concurrent prepare
+        assert con.execute("SELECT COUNT(*) FROM aircraft").fetchone()[0] == 3
+        reader.close()  # the request finishes: last reader closes it
+        with pytest.raises(sqlite3.ProgrammingError):
+            con.execute("SELECT 1")
+
 
 class TestItCanBeEvaluated:
     """
@@ -1,7 +1,13 @@
 import os
+
+import httpx
+import pytest
+from botocore.exceptions import ClientError
 from fastapi.testclient import TestClient
 
 from bdi_api.app import app
+from bdi_api.s4 import exercise as s4_exercise
+from bdi_api.s4.exercise import _first_n_filenames
 
 client = TestClient(app)
 
@@ -24,4 +30,69 @@ def test_s4_prepare_makes_s1_queries_work():
     # Now S1 endpoint should return data
     r2 = client.get("/api/s1/aircraft/", params={"num_results": 5, "page": 0})
     assert r2.status_code == 200
-    assert isinstance(r2.json(), list)
\ No newline at end of file
+    assert isinstance(r2.json(), list)
+
+
+def test_s4_download_rejects_negative_file_limit():
+    r = client.post("/api/s4/aircraft/download", params={"file_limit": -1})
+    assert r.status_code == 422
+    assert _first_n_filenames(-1) == ()
+
+
+class FakeS3:
+    """Just the head_object/put_object calls download_data makes."""
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"Metadata": self.objects[Key]["Metadata"]}
+
+    def put_object(self, Bucket, Key, Body, Metadata):
+        self.objects[Key] = {"Body": Body, "Metadata": Metadata}
+        self.puts.append(Key)
+
+
+@pytest.fixture
+def fake_origin(monkeypatch):
+    """S3 and the source website both in memory; returns (s3, file versions)."""
+    s3 = FakeS3()
+    versions = {}
+
+    def handle(request):
+        fname = request.url.path.rsplit("/", 1)[-1]
+        etag = f'"{fname}-{versions.get(fname, 0)}"'
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(200, headers={"ETag": etag}, content=b"data")
+
+    monkeypatch.setattr(s4_exercise, "_s3_client", lambda: s3)
+    monkeypatch.setattr(
+        s4_exercise,
+        "_http_client",
+        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handle), follow_redirects=True),
+    )
+    return s3, versions
+
+
+def test_s4_download_stores_and_reuses_source_etag(fake_origin):
+    s3, versions = fake_origin
+    key = s4_exercise.S3_PREFIX + "000000Z.json.gz"
+
+    assert client.post("/api/s4/aircraft/download", params={"file_limit": 2}).json() == "OK"
+    assert len(s3.puts) == 2
+    assert s3.objects[key]["Metadata"] == {"source-etag": '"000000Z.json.gz-0"'}
+
+    # Unchanged at the source: answered 304, nothing uploaded again
+    s3.puts.clear()
+    assert client.post("/api/s4/aircraft/download", params={"file_limit": 2}).json() == "OK"
+    assert s3.puts == []
+
+    # A new version is uploaded with its new ETag
+    versions["000000Z.json.gz"] = 1
+    assert client.post("/api/s4/aircraft/download", params={"file_limit": 2}).json() == "OK"
+    assert s3.puts == [key]
+    assert s3.objects[key]["Metadata"] == {"source-etag": '"000000Z.json.gz-1"'}